@@ -72,9 +72,11 @@ Environment Variables:
     FITBIT_ACCESS_TOKEN     OAuth access token (optional)
     FITBIT_REFRESH_TOKEN    OAuth refresh token (optional)
     FITBIT_REDIRECT_URI     OAuth redirect URI (default: http://localhost:8080/callback)
+    FITBIT_TOKEN_CACHE      File used to persist refreshed tokens (default: ~/.cache/fitbit_prometheus/token.json)
     METRICS_PORT            HTTP server port (default: 8080)
     METRICS_PATH            Metrics endpoint path (default: /metrics)
     EXPORT_INTERVAL         Export interval in seconds (default: 300)
+    METRICS_WORKERS         HTTP server worker processes sharing the port (default: 1)
     LOG_LEVEL               Log level (default: INFO)
 
 Examples:
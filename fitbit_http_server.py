@@ -8,163 +8,320 @@ import os
 import sys
 import time
 import threading
+import socket
 import logging
+import multiprocessing
+import gzip
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import json
 
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+except ImportError:
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
 # Import our Fitbit API classes
 from fitbit_prometheus import FitbitAPI, PrometheusMetricsExporter
 
-# Set up logging
+# Set up logging; the format uses neither thread nor process names, so skip looking them up
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
 logging.basicConfig(
     level=getattr(logging, os.getenv('LOG_LEVEL', 'INFO')),
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
+# Static exporter metadata; only the last update time and error count vary
+_METADATA_TEMPLATE = b"""# HELP fitbit_exporter_info Information about the Fitbit exporter
+# TYPE fitbit_exporter_info gauge
+fitbit_exporter_info{version="1.0.0",last_update="%b"} 1
+
+# HELP fitbit_exporter_last_update_timestamp Unix timestamp of last successful update
+# TYPE fitbit_exporter_last_update_timestamp gauge
+fitbit_exporter_last_update_timestamp %d
+
+# HELP fitbit_exporter_errors_total Total number of export errors
+# TYPE fitbit_exporter_errors_total counter
+fitbit_exporter_errors_total %d
+
+"""
+
+def _render_metadata(last_update, last_update_iso, error_count):
+    """Render the exporter metadata header that precedes the Fitbit metrics"""
+    return _METADATA_TEMPLATE % (last_update_iso.encode('ascii'), int(last_update * 1000), error_count)
+
+# Status line and headers for a 200 /metrics response, filled in per request
+_METRICS_RESPONSE_HEAD = (
+    b"%b 200 OK\r\n"
+    b"Date: %b\r\n"
+    b"Content-Type: text/plain; charset=utf-8\r\n"
+    b"Content-Length: %d\r\n"
+    b"ETag: %b\r\n"
+    b"Vary: Accept-Encoding\r\n"
+    b"%b"
+    b"\r\n"
+)
+
+@functools.lru_cache(maxsize=1)
+def _render_index(metrics_path, interval, has_client_id, has_access_token):
+    """Render the index page with links as UTF-8 bytes"""
+    html = f"""
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Fitbit Prometheus Exporter</title>
+    <style>
+        body {{ font-family: Arial, sans-serif; margin: 40px; }}
+        .status {{ padding: 10px; border-radius: 5px; margin: 10px 0; }}
+        .healthy {{ background-color: #d4edda; border: 1px solid #c3e6cb; }}
+        .unhealthy {{ background-color: #f8d7da; border: 1px solid #f5c6cb; }}
+    </style>
+</head>
+<body>
+    <h1>Fitbit Prometheus Exporter</h1>
+    <div class="status healthy">
+        <strong>Status:</strong> Running
+    </div>
+    
+    <h2>Endpoints</h2>
+    <ul>
+        <li><a href="{metrics_path}">Metrics</a> - Prometheus metrics endpoint</li>
+        <li><a href="/health">Health</a> - Health check endpoint</li>
+    </ul>
+    
+    <h2>Environment Configuration</h2>
+    <ul>
+        <li><strong>Metrics Path:</strong> {metrics_path}</li>
+        <li><strong>Export Interval:</strong> {interval} seconds</li>
+        <li><strong>Client ID:</strong> {"Set" if has_client_id else "Not Set"}</li>
+        <li><strong>Access Token:</strong> {"Set" if has_access_token else "Not Set"}</li>
+    </ul>
+</body>
+</html>
+"""
+    return html.encode('utf-8')
+
+class _WorkerFeed:
+    """Forward the latest snapshot to one worker process without blocking the publisher"""
+    
+    def __init__(self, conn):
+        self._conn = conn
+        self._pending = None
+        self._ready = threading.Event()
+        self.alive = True
+        threading.Thread(target=self._run, name='metrics-worker-feed', daemon=True).start()
+    
+    def offer(self, snapshot):
+        """Queue a snapshot, replacing one the worker hasn't been sent yet"""
+        self._pending = snapshot
+        self._ready.set()
+    
+    def _run(self):
+        while True:
+            self._ready.wait()
+            self._ready.clear()
+            snapshot, self._pending = self._pending, None
+            if snapshot is None:
+                continue
+            try:
+                self._conn.send(snapshot)
+            except (BrokenPipeError, EOFError, OSError):
+                logger.warning("Metrics worker process went away; no longer publishing to it")
+                self.alive = False
+                return
+
 class MetricsCache:
-    """Thread-safe cache for metrics data"""
+    """Thread-safe cache for metrics data
+    
+    Readers get an immutable snapshot tuple without locking. The cache has a
+    single writer (the MetricsUpdater thread), which keeps the error counter
+    and other state privately and publishes a new tuple with a single
+    attribute assignment, so neither side ever contends on a lock.
+    """
     
     def __init__(self):
-        self._metrics = ""
+        self._metrics = b""
         self._last_update = 0
-        self._lock = threading.Lock()
+        self._last_update_iso = datetime.fromtimestamp(self._last_update).isoformat()
         self._error_count = 0
         self._last_error = None
+        self._subscribers = []
+        self._last_success_log = 0
+        self._publish()
     
     def update(self, metrics, error=None):
-        """Update cached metrics"""
-        with self._lock:
-            if error:
-                self._error_count += 1
-                self._last_error = str(error)
-                logger.error(f"Failed to update metrics: {error}")
-            else:
-                self._metrics = metrics
-                self._last_update = time.time()
-                self._error_count = 0
-                self._last_error = None
+        """Update cached metrics (UTF-8 encoded bytes from the exporter); called only from the updater thread"""
+        if error:
+            self._error_count += 1
+            self._last_error = str(error)
+            logger.error(f"Failed to update metrics: {error}")
+        else:
+            self._metrics = metrics
+            self._last_update = time.time()
+            self._last_update_iso = datetime.fromtimestamp(self._last_update).isoformat()
+            self._error_count = 0
+            self._last_error = None
+            # Short export intervals would otherwise log on every tick
+            if self._last_update - self._last_success_log >= 60:
                 logger.info("Metrics updated successfully")
+                self._last_success_log = self._last_update
+            else:
+                logger.debug("Metrics updated successfully")
+        
+        self._publish()
+    
+    def _publish(self):
+        """Render, compress and publish a new snapshot once per update rather than per request"""
+        header = _render_metadata(self._last_update, self._last_update_iso, self._error_count)
+        payload = header + self._metrics
+        gzipped = gzip.compress(payload, compresslevel=6)
+        etag = hashlib.blake2b(payload, digest_size=8).hexdigest()
+        self._snapshot = (header, self._metrics, gzipped, etag, self._last_update,
+                          self._last_update_iso, self._error_count, self._last_error)
+        
+        # Forward the snapshot to worker processes serving from their own cache;
+        # each feed sends on its own thread so a stalled worker can't block this one
+        for feed in self._subscribers:
+            feed.offer(self._snapshot)
+        self._subscribers = [feed for feed in self._subscribers if feed.alive]
+    
+    def subscribe(self, conn):
+        """Send every future snapshot to a worker process over a multiprocessing connection"""
+        self._subscribers.append(_WorkerFeed(conn))
+    
+    def load(self, snapshot):
+        """Publish a snapshot produced by another process's cache"""
+        self._snapshot = snapshot
     
     def get(self):
-        """Get cached metrics"""
-        with self._lock:
-            return self._metrics, self._last_update, self._error_count, self._last_error
+        """Get the pre-encoded metadata header, metrics body, gzipped payload, ETag and status"""
+        return self._snapshot
 
 class FitbitMetricsHandler(BaseHTTPRequestHandler):
     """HTTP request handler for metrics endpoint"""
     
-    def __init__(self, cache, metrics_path, *args, **kwargs):
-        self.cache = cache
-        self.metrics_path = metrics_path
-        super().__init__(*args, **kwargs)
+    # Buffer the response so headers and body leave in as few sends as possible,
+    # and send them without waiting on Nagle's algorithm (TCP_NODELAY)
+    wbufsize = 65536
+    disable_nagle_algorithm = True
+    
+    # Keep connections open between scrapes; every response carries a
+    # Content-Length so clients know where it ends. Idle sockets are closed
+    # after the timeout so they don't pin a server thread forever.
+    protocol_version = 'HTTP/1.1'
+    timeout = 120
+    
+    # Injected by create_handler_class
+    cache = None
+    metrics_path = '/metrics'
+    routes = {}
     
     def do_GET(self):
         """Handle GET requests"""
-        parsed_path = urlparse(self.path)
+        handler = self.routes.get(self.path.partition('?')[0])
         
-        if parsed_path.path == self.metrics_path:
-            self.serve_metrics()
-        elif parsed_path.path == '/health':
-            self.serve_health()
-        elif parsed_path.path == '/':
-            self.serve_index()
+        if handler:
+            handler(self)
         else:
             self.send_error(404, "Not Found")
     
     def serve_metrics(self):
         """Serve Prometheus metrics"""
-        metrics, last_update, error_count, last_error = self.cache.get()
+        header, body, gzipped, etag, last_update, _, error_count, last_error = self.cache.get()
         
-        if not metrics and error_count > 0:
+        if not last_update and error_count > 0:
             self.send_error(503, f"Service Unavailable: {last_error}")
             return
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/plain; charset=utf-8')
-        self.end_headers()
+        use_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+        # Each representation gets its own strong validator
+        etag = f'"{etag}-gzip"' if use_gzip else f'"{etag}"'
         
-        # Add metadata about the exporter
-        metadata = f"""# HELP fitbit_exporter_info Information about the Fitbit exporter
-# TYPE fitbit_exporter_info gauge
-fitbit_exporter_info{{version="1.0.0",last_update="{datetime.fromtimestamp(last_update).isoformat()}"}} 1
-
-# HELP fitbit_exporter_last_update_timestamp Unix timestamp of last successful update
-# TYPE fitbit_exporter_last_update_timestamp gauge
-fitbit_exporter_last_update_timestamp {int(last_update * 1000)}
-
-# HELP fitbit_exporter_errors_total Total number of export errors
-# TYPE fitbit_exporter_errors_total counter
-fitbit_exporter_errors_total {error_count}
-
-"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+        
+        # Skip the send_header helpers: format the head in one go and hand it,
+        # together with the cached payload, to a single gathering send
+        if use_gzip:
+            payload = (gzipped,)
+            encoding = b"Content-Encoding: gzip\r\n"
+        else:
+            payload = (header, body)
+            encoding = b""
+        
+        size = sum(len(part) for part in payload)
+        head = _METRICS_RESPONSE_HEAD % (
+            self.protocol_version.encode('ascii'),
+            self.date_time_string().encode('ascii'),
+            size,
+            etag.encode('ascii'),
+            encoding,
+        )
         
-        self.wfile.write((metadata + metrics).encode('utf-8'))
+        self.log_request(200, size)
+        self._send_buffers(head, *payload)
+    
+    def _send_buffers(self, *buffers):
+        """Write buffers to the socket with one sendmsg, finishing any short send with sendall"""
+        sent = self.connection.sendmsg(buffers)
+        for buf in buffers:
+            if sent >= len(buf):
+                sent -= len(buf)
+                continue
+            self.connection.sendall(memoryview(buf)[sent:])
+            sent = 0
     
     def serve_health(self):
         """Serve health check endpoint"""
-        metrics, last_update, error_count, last_error = self.cache.get()
+        _, _, _, _, last_update, last_update_iso, error_count, last_error = self.cache.get()
         
         # Consider healthy if we have recent data (within last 10 minutes)
         is_healthy = (time.time() - last_update) < 600
         
-        status_code = 200 if is_healthy else 503
-        self.send_response(status_code)
-        self.send_header('Content-Type', 'application/json')
-        self.end_headers()
-        
         health_data = {
             'status': 'healthy' if is_healthy else 'unhealthy',
-            'last_update': datetime.fromtimestamp(last_update).isoformat() if last_update else None,
+            'last_update': last_update_iso if last_update else None,
             'error_count': error_count,
             'last_error': last_error
         }
+        body = _json_dumps(health_data)
         
-        self.wfile.write(json.dumps(health_data, indent=2).encode('utf-8'))
+        status_code = 200 if is_healthy else 503
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        
+        self.wfile.write(body)
     
     def serve_index(self):
         """Serve index page with links"""
+        body = _render_index(
+            self.metrics_path,
+            os.getenv('EXPORT_INTERVAL', '300'),
+            bool(os.getenv('FITBIT_CLIENT_ID')),
+            bool(os.getenv('FITBIT_ACCESS_TOKEN')),
+        )
+        
         self.send_response(200)
         self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
         
-        html = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <title>Fitbit Prometheus Exporter</title>
-    <style>
-        body {{ font-family: Arial, sans-serif; margin: 40px; }}
-        .status {{ padding: 10px; border-radius: 5px; margin: 10px 0; }}
-        .healthy {{ background-color: #d4edda; border: 1px solid #c3e6cb; }}
-        .unhealthy {{ background-color: #f8d7da; border: 1px solid #f5c6cb; }}
-    </style>
-</head>
-<body>
-    <h1>Fitbit Prometheus Exporter</h1>
-    <div class="status healthy">
-        <strong>Status:</strong> Running
-    </div>
-    
-    <h2>Endpoints</h2>
-    <ul>
-        <li><a href="{self.metrics_path}">Metrics</a> - Prometheus metrics endpoint</li>
-        <li><a href="/health">Health</a> - Health check endpoint</li>
-    </ul>
-    
-    <h2>Environment Configuration</h2>
-    <ul>
-        <li><strong>Metrics Path:</strong> {self.metrics_path}</li>
-        <li><strong>Export Interval:</strong> {os.getenv('EXPORT_INTERVAL', '300')} seconds</li>
-        <li><strong>Client ID:</strong> {"Set" if os.getenv('FITBIT_CLIENT_ID') else "Not Set"}</li>
-        <li><strong>Access Token:</strong> {"Set" if os.getenv('FITBIT_ACCESS_TOKEN') else "Not Set"}</li>
-    </ul>
-</body>
-</html>
-"""
-        self.wfile.write(html.encode('utf-8'))
+        self.wfile.write(body)
     
     def log_message(self, format, *args):
         """Override to use our logger"""
@@ -177,21 +334,25 @@ class MetricsUpdater:
         self.cache = cache
         self.interval = interval
         self.fitbit = None
-        self.running = False
+        self.exporter = None
         self.thread = None
+        self._stop = threading.Event()
+        # Fitbit endpoints are independent HTTP round-trips, so fetch them concurrently
+        self._pool = ThreadPoolExecutor(max_workers=6, thread_name_prefix='fitbit-export')
     
     def start(self):
         """Start the background updater"""
-        self.running = True
+        self._stop.clear()
         self.thread = threading.Thread(target=self._run, daemon=True)
         self.thread.start()
         logger.info(f"Started metrics updater with {self.interval}s interval")
     
     def stop(self):
         """Stop the background updater"""
-        self.running = False
+        self._stop.set()
         if self.thread:
             self.thread.join(timeout=5)
+        self._pool.shutdown(wait=False, cancel_futures=True)
     
     def _run(self):
         """Main updater loop"""
@@ -200,59 +361,147 @@ class MetricsUpdater:
             self.fitbit = FitbitAPI()
             if not self.fitbit.access_token:
                 raise ValueError("No access token available. Set FITBIT_ACCESS_TOKEN environment variable.")
+            self.exporter = PrometheusMetricsExporter(self.fitbit)
         except Exception as e:
             logger.error(f"Failed to initialize Fitbit API: {e}")
-            self.cache.update("", error=e)
+            self.cache.update(b"", error=e)
             return
         
         # Initial update
         self._update_metrics()
         
-        # Periodic updates
-        while self.running:
-            time.sleep(self.interval)
-            if self.running:
-                self._update_metrics()
+        # Periodic updates; wait() returns early as soon as stop() is called
+        while not self._stop.wait(self.interval):
+            self._update_metrics()
     
     def _update_metrics(self):
         """Update metrics from Fitbit API"""
         try:
             logger.info("Updating metrics from Fitbit API...")
             
-            # Create exporter and gather metrics
-            exporter = PrometheusMetricsExporter(self.fitbit)
+            # Reuse the exporter across updates, starting from an empty collection
+            exporter = self.exporter
+            exporter.reset()
             
             # Export all available data
-            exporter.export_user_profile()
-            exporter.export_daily_activity()
-            exporter.export_heart_rate()
-            exporter.export_sleep_data()
-            # exporter.export_weight_data() Uncomment for weight data
+            futures = [
+                self._pool.submit(exporter.export_user_profile),
+                self._pool.submit(exporter.export_daily_activity),
+                self._pool.submit(exporter.export_heart_rate),
+                self._pool.submit(exporter.export_sleep_data),
+                # self._pool.submit(exporter.export_weight_data), Uncomment for weight data
+            ]
             
             # Export time series for common metrics
-            for resource in ['steps', 'distance', 'calories']:
-                try:
-                    exporter.export_time_series(resource, days=7)
-                except Exception as e:
-                    logger.warning(f"Failed to export {resource} time series: {e}")
+            time_series = {
+                self._pool.submit(exporter.export_time_series, resource, 7): resource
+                for resource in ['steps', 'distance', 'calories']
+            }
+            
+            wait(futures + list(time_series))
+            for future, resource in time_series.items():
+                if future.exception():
+                    logger.warning(f"Failed to export {resource} time series: {future.exception()}")
             
-            metrics = exporter.get_metrics()
-            self.cache.update(metrics)
+            self.cache.update(exporter.get_metrics())
             
         except Exception as e:
             logger.error(f"Failed to update metrics: {e}")
-            self.cache.update("", error=e)
+            self.cache.update(b"", error=e)
 
 def create_handler_class(cache, metrics_path):
     """Create a handler class with injected dependencies"""
-    def handler(*args, **kwargs):
-        return FitbitMetricsHandler(cache, metrics_path, *args, **kwargs)
-    return handler
+    return type('BoundFitbitMetricsHandler', (FitbitMetricsHandler,), {
+        'cache': cache,
+        'metrics_path': metrics_path,
+        'routes': {
+            metrics_path: FitbitMetricsHandler.serve_metrics,
+            '/health': FitbitMetricsHandler.serve_health,
+            '/': FitbitMetricsHandler.serve_index,
+        },
+    })
+
+class ReusePortHTTPServer(ThreadingHTTPServer):
+    """Threading HTTP server that shares its port with other worker processes"""
+    
+    def server_bind(self):
+        """Set SO_REUSEPORT so the kernel load-balances connections across workers"""
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+def _run_worker(cache, conn, port, metrics_path):
+    """Serve metrics from a forked worker process, following the parent's snapshots"""
+    server = ReusePortHTTPServer(('0.0.0.0', port), create_handler_class(cache, metrics_path))
+    
+    def follow():
+        # The parent closing its end of the pipe means it has exited
+        try:
+            while True:
+                cache.load(conn.recv())
+        except (EOFError, OSError):
+            pass
+        server.shutdown()
+    
+    threading.Thread(target=follow, daemon=True).start()
+    
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
-def start_server(port=8080, metrics_path='/metrics', interval=300):
+def _fork_workers(cache, count, port, metrics_path):
+    """Fork worker processes that serve metrics published by this process's cache"""
+    pids = []
+    send_conns = []
+    
+    for _ in range(count):
+        recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+        send_conns.append(send_conn)
+        
+        pid = os.fork()
+        if pid == 0:
+            # Drop every write end so the pipe reports EOF once the parent exits
+            for conn in send_conns:
+                conn.close()
+            # Never let the child unwind back into the parent's start_server code path
+            exit_code = 1
+            try:
+                _run_worker(cache, recv_conn, port, metrics_path)
+                exit_code = 0
+            except BaseException:
+                logger.exception("Metrics worker process failed")
+            finally:
+                os._exit(exit_code)
+        
+        recv_conn.close()
+        pids.append(pid)
+    
+    # Subscribing starts a feed thread per worker, so only do it once all forks are done
+    for send_conn in send_conns:
+        cache.subscribe(send_conn)
+    
+    return pids
+
+def _reap_workers(pids):
+    """Wait for worker processes so exited ones don't linger as zombies, and report them"""
+    remaining = set(pids)
+    while remaining:
+        try:
+            pid, status = os.waitpid(-1, 0)
+        except ChildProcessError:
+            return
+        if pid in remaining:
+            remaining.discard(pid)
+            logger.error(f"Metrics worker process {pid} exited with status "
+                         f"{os.waitstatus_to_exitcode(status)}; {len(remaining)} worker processes left")
+
+def start_server(port=8080, metrics_path='/metrics', interval=300, workers=1):
     """Start the HTTP server"""
     port = int(port)
     interval = int(interval)
+    workers = int(workers)
     
     logger.info(f"Starting Fitbit Prometheus Exporter on port {port}")
     logger.info(f"Metrics endpoint: http://localhost:{port}{metrics_path}")
@@ -261,13 +510,23 @@ def start_server(port=8080, metrics_path='/metrics', interval=300):
     # Create metrics cache
     cache = MetricsCache()
     
+    # Fork extra serving processes before any threads are started. Only this
+    # process talks to the Fitbit API; workers receive each new snapshot over a pipe.
+    if workers > 1:
+        logger.info(f"Starting {workers - 1} additional worker processes")
+        pids = _fork_workers(cache, workers - 1, port, metrics_path)
+        threading.Thread(target=_reap_workers, args=(pids,), name='metrics-worker-reaper', daemon=True).start()
+        server_class = ReusePortHTTPServer
+    else:
+        server_class = ThreadingHTTPServer
+    
     # Start metrics updater
     updater = MetricsUpdater(cache, interval)
     updater.start()
     
     # Create and start HTTP server
     handler_class = create_handler_class(cache, metrics_path)
-    server = HTTPServer(('0.0.0.0', port), handler_class)
+    server = server_class(('0.0.0.0', port), handler_class)
     
     try:
         logger.info("Server started successfully")
@@ -283,5 +542,6 @@ if __name__ == "__main__":
     start_server(
         port=os.getenv('METRICS_PORT', 8080),
         metrics_path=os.getenv('METRICS_PATH', '/metrics'),
-        interval=int(os.getenv('EXPORT_INTERVAL', 300))
+        interval=int(os.getenv('EXPORT_INTERVAL', 300)),
+        workers=int(os.getenv('METRICS_WORKERS', 1))
     )
\ No newline at end of file
@@ -5,7 +5,12 @@ Queries the Fitbit API and outputs Prometheus-compliant metrics format.
 """
 
 import os
+import io
+import base64
+import sys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 from datetime import datetime, timedelta
 from urllib.parse import urlencode
@@ -14,6 +19,33 @@ from http.server import HTTPServer, BaseHTTPRequestHandler
 import threading
 import time
 import argparse
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial, lru_cache
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Where tokens obtained or refreshed at runtime are kept between runs
+DEFAULT_TOKEN_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'fitbit_prometheus', 'token.json')
+
+# Refresh this many seconds before the access token actually expires
+TOKEN_EXPIRY_MARGIN = 60
+
+# (connect, read) timeout in seconds applied to every Fitbit HTTP call
+HTTP_TIMEOUT = (3.05, 10)
+
+# How long the interactive OAuth flow waits for the browser redirect
+AUTH_CALLBACK_TIMEOUT = 300
+
+# Seconds to reuse responses for sections that change rarely between scrapes
+PROFILE_CACHE_TTL = 3600
+WEIGHT_CACHE_TTL = 3600
+# Kept well apart from the default 300s EXPORT_INTERVAL so the heart rate summary is
+# actually reused on most cycles instead of expiring right around each export
+HEART_RATE_CACHE_TTL = 900
 
 class FitbitAPI:
     def __init__(self):
@@ -23,6 +55,8 @@ class FitbitAPI:
         self.redirect_uri = os.getenv('FITBIT_REDIRECT_URI', 'http://localhost:8080/callback')
         self.access_token = os.getenv('FITBIT_ACCESS_TOKEN')
         self.refresh_token = os.getenv('FITBIT_REFRESH_TOKEN')
+        self.expires_at = None  # Unknown for tokens passed in via the environment
+        self.token_cache_path = os.getenv('FITBIT_TOKEN_CACHE', DEFAULT_TOKEN_CACHE_PATH)
         
         # Fitbit API endpoints
         self.auth_url = 'https://www.fitbit.com/oauth2/authorize'
@@ -32,6 +66,99 @@ class FitbitAPI:
         # Validate required environment variables
         if not self.client_id or not self.client_secret:
             raise ValueError("FITBIT_CLIENT_ID and FITBIT_CLIENT_SECRET must be set as environment variables")
+        
+        # Client credentials for the token endpoint never change, so encode them once
+        self._basic_auth = 'Basic ' + base64.b64encode(f"{self.client_id}:{self.client_secret}".encode()).decode()
+        
+        # Fall back to tokens persisted by an earlier run
+        if not self.access_token:
+            self._load_cached_tokens()
+        
+        # Share one connection pool across all calls so TLS sessions to api.fitbit.com are reused
+        self.session = requests.Session()
+        # Transient 5xx responses to GETs are retried with a short backoff; the last response
+        # is returned as-is so the status checks below still apply. Token POSTs are never
+        # retried: refresh tokens are single-use, so resending one after a lost response would
+        # lock the client out. 429 isn't retried either, as Fitbit's Retry-After runs until the
+        # hourly quota resets and would stall the caller for up to an hour.
+        retry = Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=('GET',),
+            respect_retry_after_header=False,
+            raise_on_status=False
+        )
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+        self._set_auth_header()
+        
+        # Fitbit rotates refresh tokens, so concurrent requests must not refresh twice;
+        # _token_version is bumped whenever new tokens are adopted
+        self._refresh_lock = threading.Lock()
+        self._token_version = 0
+        
+        # endpoint -> (expires_at, response) for responses served by _cached_api_request
+        self._response_cache = {}
+        self._response_cache_lock = threading.Lock()
+    
+    def _set_auth_header(self):
+        """Point the session's bearer Authorization header at the current access token"""
+        if self.access_token:
+            self.session.headers['Authorization'] = f'Bearer {self.access_token}'
+        else:
+            self.session.headers.pop('Authorization', None)
+    
+    def _load_cached_tokens(self):
+        """Load access/refresh tokens and their expiry from the token cache file"""
+        try:
+            with open(self.token_cache_path) as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"# Ignoring unreadable token cache {self.token_cache_path}: {e}")
+            return
+        
+        self.access_token = cached.get('access_token')
+        self.refresh_token = cached.get('refresh_token') or self.refresh_token
+        self.expires_at = cached.get('expires_at')
+    
+    def _save_cached_tokens(self):
+        """Persist the current tokens and their expiry to the token cache file (mode 0600)"""
+        try:
+            os.makedirs(os.path.dirname(self.token_cache_path), mode=0o700, exist_ok=True)
+            fd = os.open(self.token_cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({
+                    'access_token': self.access_token,
+                    'refresh_token': self.refresh_token,
+                    'expires_at': self.expires_at
+                }, f)
+        except OSError as e:
+            print(f"# Could not write token cache {self.token_cache_path}: {e}")
+    
+    def _store_tokens(self, token_data):
+        """Adopt tokens from an OAuth token response and remember when they expire"""
+        self.access_token = token_data['access_token']
+        self.refresh_token = token_data['refresh_token']
+        if 'expires_in' in token_data:
+            self.expires_at = time.time() + token_data['expires_in'] - TOKEN_EXPIRY_MARGIN
+        else:
+            self.expires_at = None
+        self._token_version += 1
+        self._set_auth_header()
+        self._save_cached_tokens()
+    
+    def _ensure_fresh_token(self):
+        """Refresh the access token ahead of time when it is known to have expired"""
+        expires_at = self.expires_at
+        if expires_at is not None and self.refresh_token and time.time() >= expires_at:
+            with self._refresh_lock:
+                # Another thread may have refreshed while we waited for the lock, possibly
+                # to a token whose response carried no expiry
+                expires_at = self.expires_at
+                if expires_at is not None and time.time() >= expires_at:
+                    self.refresh_access_token()
     
     def get_authorization_url(self):
         """Generate the authorization URL for OAuth flow"""
@@ -48,7 +175,7 @@ class FitbitAPI:
         """Exchange authorization code for access token"""
         headers = {
             'Content-Type': 'application/x-www-form-urlencoded',
-            'Authorization': f'Basic {self._get_basic_auth_header()}'
+            'Authorization': self._basic_auth
         }
         
         data = {
@@ -58,12 +185,11 @@ class FitbitAPI:
             'code': authorization_code
         }
         
-        response = requests.post(self.token_url, headers=headers, data=data)
+        response = self.session.post(self.token_url, headers=headers, data=data, timeout=HTTP_TIMEOUT)
         
         if response.status_code == 200:
-            token_data = response.json()
-            self.access_token = token_data['access_token']
-            self.refresh_token = token_data['refresh_token']
+            token_data = _json_loads(response.content)
+            self._store_tokens(token_data)
             
             print("# Tokens obtained successfully!")
             print(f"# Access Token: {self.access_token}")
@@ -83,7 +209,7 @@ class FitbitAPI:
         
         headers = {
             'Content-Type': 'application/x-www-form-urlencoded',
-            'Authorization': f'Basic {self._get_basic_auth_header()}'
+            'Authorization': self._basic_auth
         }
         
         data = {
@@ -91,50 +217,60 @@ class FitbitAPI:
             'refresh_token': self.refresh_token
         }
         
-        response = requests.post(self.token_url, headers=headers, data=data)
+        response = self.session.post(self.token_url, headers=headers, data=data, timeout=HTTP_TIMEOUT)
         
         if response.status_code == 200:
-            token_data = response.json()
-            self.access_token = token_data['access_token']
-            self.refresh_token = token_data['refresh_token']
+            token_data = _json_loads(response.content)
+            self._store_tokens(token_data)
             return token_data
         else:
             raise Exception(f"Failed to refresh token: {response.status_code} - {response.text}")
     
-    def _get_basic_auth_header(self):
-        """Get basic auth header for client credentials"""
-        import base64
-        credentials = f"{self.client_id}:{self.client_secret}"
-        encoded_credentials = base64.b64encode(credentials.encode()).decode()
-        return encoded_credentials
-    
     def _make_api_request(self, endpoint, params=None):
         """Make authenticated API request"""
         if not self.access_token:
             raise ValueError("No access token available. Please authenticate first.")
         
-        headers = {
-            'Authorization': f'Bearer {self.access_token}'
-        }
+        self._ensure_fresh_token()
         
         url = f"{self.api_base_url}{endpoint}"
-        response = requests.get(url, headers=headers, params=params)
+        token_version = self._token_version
+        response = self.session.get(url, params=params, timeout=HTTP_TIMEOUT)
         
         if response.status_code == 401:
-            # Token expired, try to refresh
-            print("# Access token expired, attempting to refresh...")
-            self.refresh_access_token()
-            headers['Authorization'] = f'Bearer {self.access_token}'
-            response = requests.get(url, headers=headers, params=params)
+            # Token expired, try to refresh (this also updates the session header)
+            # unless another thread already replaced the token this request used
+            with self._refresh_lock:
+                if self._token_version == token_version:
+                    print("# Access token expired, attempting to refresh...")
+                    self.refresh_access_token()
+            response = self.session.get(url, params=params, timeout=HTTP_TIMEOUT)
         
         if response.status_code == 200:
-            return response.json()
+            return _json_loads(response.content)
+        elif response.status_code == 429:
+            # Quota resets at the top of the hour; don't treat this as an auth failure
+            retry_after = response.headers.get('Retry-After', 'unknown')
+            raise Exception(f"API rate limit exceeded (retry after {retry_after}s): {response.text}")
         else:
             raise Exception(f"API request failed: {response.status_code} - {response.text}")
     
+    def _cached_api_request(self, endpoint, ttl):
+        """Make an API request, reusing a successful response for ttl seconds"""
+        with self._response_cache_lock:
+            entry = self._response_cache.get(endpoint)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        
+        data = self._make_api_request(endpoint)
+        # Stamp the expiry once the response has arrived, not when the request started
+        with self._response_cache_lock:
+            self._response_cache[endpoint] = (time.monotonic() + ttl, data)
+        return data
+    
     def get_user_profile(self):
         """Get user profile information"""
-        return self._make_api_request('/profile.json')
+        return self._cached_api_request('/profile.json', PROFILE_CACHE_TTL)
     
     def get_daily_activity_summary(self, date=None):
         """Get daily activity summary for a specific date"""
@@ -148,7 +284,7 @@ class FitbitAPI:
         if date is None:
             date = datetime.now().strftime('%Y-%m-%d')
         
-        return self._make_api_request(f'/activities/heart/date/{date}/1d.json')
+        return self._cached_api_request(f'/activities/heart/date/{date}/1d.json', HEART_RATE_CACHE_TTL)
     
     def get_sleep_data(self, date=None):
         """Get sleep data for a specific date"""
@@ -162,7 +298,7 @@ class FitbitAPI:
         if date is None:
             date = datetime.now().strftime('%Y-%m-%d')
         
-        return self._make_api_request(f'/body/log/weight/date/{date}.json')
+        return self._cached_api_request(f'/body/log/weight/date/{date}.json', WEIGHT_CACHE_TTL)
     
     def get_activity_time_series(self, resource, date=None, period='1m'):
         """Get activity time series data"""
@@ -170,28 +306,101 @@ class FitbitAPI:
             date = datetime.now().strftime('%Y-%m-%d')
         
         return self._make_api_request(f'/activities/{resource}/date/{date}/{period}.json')
+    
+    def get_activity_time_series_range(self, resource, start_date, end_date):
+        """Get activity time series data for every day between two dates in one request"""
+        return self._make_api_request(f'/activities/{resource}/date/{start_date}/{end_date}.json')
+
+
+# Exposition line shapes, filled with bytes %-formatting
+_HELP_LINE = b"# HELP %b %b\n"
+_TYPE_LINE = b"# TYPE %b %b\n"
+_SAMPLE_LINE = b"%b %b %d\n"
+_LABELED_SAMPLE_LINE = b"%b{%b} %b %d\n"
+
+
+# Unit conversions applied to Fitbit's imperial readings
+_METERS_PER_MILE = 1609.344
+_KG_PER_LB = 0.453592
+
+
+# Label values must escape backslash, double-quote and line feed
+_LABEL_ESCAPE = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n'})
+
+# Error messages can embed whole response bodies; keep the label bounded
+_MAX_ERROR_LABEL_LENGTH = 200
+
+
+def _error_label(error):
+    """Render an exception as a bounded-length label value"""
+    return str(error)[:_MAX_ERROR_LABEL_LENGTH]
+
+
+@lru_cache(maxsize=256)
+def _render_labels(label_items):
+    """Render a tuple of (name, value) pairs as an escaped exposition label fragment"""
+    return ','.join([f'{k}="{str(v).translate(_LABEL_ESCAPE)}"' for k, v in label_items]).encode('utf-8')
+
+
+def _format_value(value):
+    """Render a sample value as exposition-format bytes"""
+    if isinstance(value, int):
+        return b"%d" % value
+    if isinstance(value, float):
+        return b"%r" % value
+    return str(value).encode('utf-8')
 
 
 class PrometheusMetricsExporter:
     """Export Fitbit data in Prometheus metrics format"""
     
-    def __init__(self, fitbit_api):
+    def __init__(self, fitbit_api, out=None, collect_samples=False):
         self.fitbit = fitbit_api
-        self.metrics = []
+        # UTF-8 encoded exposition lines are written to out as they are produced;
+        # without one they are collected in memory for get_metrics()
+        self._out = out if out is not None else io.BytesIO()
+        self._buffered = out is None
+        # Optionally also keep (name, label items, value) tuples for get_samples()
+        self._samples = [] if collect_samples else None
         self.timestamp = int(time.time() * 1000)  # Prometheus timestamp in milliseconds
+        self._today = datetime.now().strftime('%Y-%m-%d')  # Date label used when no date is given
+        self._declared = set()  # Metric names whose HELP/TYPE lines were already written
+        self._lock = threading.Lock()  # export_* methods may run concurrently
+    
+    def reset(self):
+        """Clear collected metrics so the exporter can be reused for another export"""
+        with self._lock:
+            if self._buffered:
+                self._out.seek(0)
+                self._out.truncate()
+            self._declared.clear()
+            if self._samples is not None:
+                self._samples.clear()
+            self.timestamp = int(time.time() * 1000)
+            self._today = datetime.now().strftime('%Y-%m-%d')
     
     def _add_metric(self, metric_name, value, labels=None, help_text=None, metric_type='gauge'):
-        """Add a metric to the collection"""
-        if help_text:
-            self.metrics.append(f"# HELP {metric_name} {help_text}")
-        if metric_type:
-            self.metrics.append(f"# TYPE {metric_name} {metric_type}")
-        
-        if labels:
-            label_str = ','.join([f'{k}="{v}"' for k, v in labels.items()])
-            self.metrics.append(f"{metric_name}{{{label_str}}} {value} {self.timestamp}")
+        """Add a metric to the collection; labels is a dict or a tuple of (name, value) pairs"""
+        name = metric_name.encode('utf-8')
+        label_items = labels if isinstance(labels, tuple) else tuple(labels.items()) if labels else ()
+        if label_items:
+            line = _LABELED_SAMPLE_LINE % (name, _render_labels(label_items), _format_value(value), self.timestamp)
         else:
-            self.metrics.append(f"{metric_name} {value} {self.timestamp}")
+            line = _SAMPLE_LINE % (name, _format_value(value), self.timestamp)
+        
+        with self._lock:
+            # HELP/TYPE may only appear once per metric family; they go out in the same write as the sample
+            if metric_name not in self._declared:
+                head = b''
+                if help_text:
+                    head += _HELP_LINE % (name, help_text.encode('utf-8'))
+                if metric_type:
+                    head += _TYPE_LINE % (name, metric_type.encode('utf-8'))
+                line = head + line
+                self._declared.add(metric_name)
+            self._out.write(line)
+            if self._samples is not None:
+                self._samples.append((metric_name, label_items, value))
     
     def export_user_profile(self):
         """Export user profile metrics"""
@@ -229,7 +438,7 @@ class PrometheusMetricsExporter:
             self._add_metric(
                 'fitbit_user_profile_error',
                 1,
-                labels={'error': str(e)},
+                labels={'error': _error_label(e)},
                 help_text='Error fetching user profile',
                 metric_type='counter'
             )
@@ -240,7 +449,7 @@ class PrometheusMetricsExporter:
             activity = self.fitbit.get_daily_activity_summary(date)
             summary = activity['summary']
             
-            date_str = date or datetime.now().strftime('%Y-%m-%d')
+            date_str = date or self._today
             base_labels = {'date': date_str}
             
             # Steps
@@ -255,10 +464,10 @@ class PrometheusMetricsExporter:
             # Distance (convert to meters for consistency)
             if summary['distances']:
                 distance_miles = float(summary['distances'][0]['distance'])
-                distance_meters = distance_miles * 1609.344
+                distance_meters = distance_miles * _METERS_PER_MILE
                 self._add_metric(
                     'fitbit_daily_distance_meters',
-                    round(distance_meters, 2),
+                    f'{distance_meters:.2f}',
                     labels=base_labels,
                     help_text='Total distance traveled in meters',
                     metric_type='gauge'
@@ -320,7 +529,7 @@ class PrometheusMetricsExporter:
             self._add_metric(
                 'fitbit_daily_activity_error',
                 1,
-                labels={'error': str(e), 'date': date or 'today'},
+                labels={'error': _error_label(e), 'date': date or 'today'},
                 help_text='Error fetching daily activity',
                 metric_type='counter'
             )
@@ -332,7 +541,7 @@ class PrometheusMetricsExporter:
             
             if heart_rate['activities-heart']:
                 hr_data = heart_rate['activities-heart'][0]['value']
-                date_str = date or datetime.now().strftime('%Y-%m-%d')
+                date_str = date or self._today
                 base_labels = {'date': date_str}
                 
                 # Resting heart rate
@@ -386,7 +595,7 @@ class PrometheusMetricsExporter:
             self._add_metric(
                 'fitbit_heart_rate_error',
                 1,
-                labels={'error': str(e), 'date': date or 'today'},
+                labels={'error': _error_label(e), 'date': date or 'today'},
                 help_text='Error fetching heart rate data',
                 metric_type='counter'
             )
@@ -398,7 +607,7 @@ class PrometheusMetricsExporter:
             
             if sleep['sleep']:
                 sleep_data = sleep['sleep'][0]
-                date_str = date or datetime.now().strftime('%Y-%m-%d')
+                date_str = date or self._today
                 base_labels = {'date': date_str}
                 
                 # Sleep duration in minutes
@@ -455,7 +664,7 @@ class PrometheusMetricsExporter:
             self._add_metric(
                 'fitbit_sleep_data_error',
                 1,
-                labels={'error': str(e), 'date': date or 'today'},
+                labels={'error': _error_label(e), 'date': date or 'today'},
                 help_text='Error fetching sleep data',
                 metric_type='counter'
             )
@@ -467,12 +676,12 @@ class PrometheusMetricsExporter:
             
             if weight['weight']:
                 weight_data = weight['weight'][0]
-                date_str = date or datetime.now().strftime('%Y-%m-%d')
+                date_str = date or self._today
                 base_labels = {'date': date_str}
                 
                 # Weight in pounds and kilograms
                 weight_lbs = weight_data['weight']
-                weight_kg = weight_lbs * 0.453592  # Convert to kg
+                weight_kg = weight_lbs * _KG_PER_LB  # Convert to kg
                 
                 self._add_metric(
                     'fitbit_weight_pounds',
@@ -484,7 +693,7 @@ class PrometheusMetricsExporter:
                 
                 self._add_metric(
                     'fitbit_weight_kg',
-                    round(weight_kg, 2),
+                    f'{weight_kg:.2f}',
                     labels=base_labels,
                     help_text='Weight in kilograms',
                     metric_type='gauge'
@@ -503,52 +712,67 @@ class PrometheusMetricsExporter:
             self._add_metric(
                 'fitbit_weight_data_error',
                 1,
-                labels={'error': str(e), 'date': date or 'today'},
+                labels={'error': _error_label(e), 'date': date or 'today'},
                 help_text='Error fetching weight data',
                 metric_type='counter'
             )
     
     def export_time_series(self, resource, days=7):
-        """Export time series data"""
+        """Export time series data; returns False if the data could not be fetched"""
+        if days < 1:
+            # An empty window would put start_date after end_date, which Fitbit rejects
+            return True
+        
         try:
             end_date = datetime.now()
+            start_date = end_date - timedelta(days=days - 1)
             
-            for i in range(days):
-                current_date = end_date - timedelta(days=i)
-                date_str = current_date.strftime('%Y-%m-%d')
-                
-                # Get single day data for the resource
-                time_series = self.fitbit.get_activity_time_series(resource, date_str, '1d')
+            # Fetch the whole window with a single range request
+            time_series = self.fitbit.get_activity_time_series_range(
+                resource,
+                start_date.strftime('%Y-%m-%d'),
+                end_date.strftime('%Y-%m-%d')
+            )
+            
+            if f'activities-{resource}' in time_series:
+                data_points = time_series[f'activities-{resource}']
+                resource_label = ('resource', resource)
                 
-                if f'activities-{resource}' in time_series:
-                    data_points = time_series[f'activities-{resource}']
+                for point in data_points:
+                    # Label tuples hit the _render_labels cache on every later export of the same window
+                    self._add_metric(
+                        f'fitbit_timeseries_{resource}',
+                        float(point['value']),
+                        labels=(('date', point['dateTime']), resource_label),
+                        help_text=f'Time series data for {resource}',
+                        metric_type='gauge'
+                    )
+            
+            return True
                     
-                    for point in data_points:
-                        labels = {
-                            'date': point['dateTime'],
-                            'resource': resource
-                        }
-                        
-                        self._add_metric(
-                            f'fitbit_timeseries_{resource}',
-                            float(point['value']),
-                            labels=labels,
-                            help_text=f'Time series data for {resource}',
-                            metric_type='gauge'
-                        )
-                        
         except Exception as e:
             self._add_metric(
                 'fitbit_time_series_error',
                 1,
-                labels={'error': str(e), 'resource': resource},
+                labels={'error': _error_label(e), 'resource': resource},
                 help_text='Error fetching time series data',
                 metric_type='counter'
             )
+            return False
     
     def get_metrics(self):
-        """Get all metrics as Prometheus format string"""
-        return '\n'.join(self.metrics)
+        """Get all metrics as UTF-8 encoded Prometheus format bytes (in-memory exporters only)"""
+        if not self._buffered:
+            raise ValueError("Metrics were streamed to the output stream and are not kept in memory")
+        with self._lock:
+            return self._out.getvalue()
+    
+    def get_samples(self):
+        """Get raw (metric_name, label_items, value) tuples, all taken at self.timestamp (collect_samples exporters only)"""
+        if self._samples is None:
+            raise ValueError("Exporter was not created with collect_samples=True")
+        with self._lock:
+            return list(self._samples)
 
 
 class CallbackHandler(BaseHTTPRequestHandler):
@@ -561,6 +785,7 @@ class CallbackHandler(BaseHTTPRequestHandler):
         
         if 'code' in query_params:
             self.server.authorization_code = query_params['code'][0]
+            self.server.done.set()
             self.send_response(200)
             self.send_header('Content-type', 'text/html')
             self.end_headers()
@@ -582,6 +807,7 @@ def authenticate_fitbit():
     # Start local server for callback
     server = HTTPServer(('localhost', 8080), CallbackHandler)
     server.authorization_code = None
+    server.done = threading.Event()
     
     # Start server in background thread
     server_thread = threading.Thread(target=server.serve_forever)
@@ -595,10 +821,13 @@ def authenticate_fitbit():
     
     # Wait for callback
     print("# Waiting for authorization callback...")
-    while server.authorization_code is None:
-        time.sleep(1)
+    received = server.done.wait(timeout=AUTH_CALLBACK_TIMEOUT)
     
     server.shutdown()
+    server.server_close()
+    
+    if not received:
+        raise Exception(f"No authorization callback received within {AUTH_CALLBACK_TIMEOUT} seconds")
     
     # Exchange code for tokens
     fitbit.exchange_code_for_token(server.authorization_code)
@@ -627,22 +856,28 @@ def main():
         elif not fitbit.access_token:
             raise ValueError("No access token found. Remove --skip-auth or set FITBIT_ACCESS_TOKEN")
         
-        # Create metrics exporter
-        exporter = PrometheusMetricsExporter(fitbit)
+        # Create metrics exporter; metrics are streamed to stdout as they are produced
+        sys.stdout.flush()
+        exporter = PrometheusMetricsExporter(fitbit, out=sys.stdout.buffer)
         
         # Export various metrics
-        exporter.export_user_profile()
-        exporter.export_daily_activity(args.date)
-        exporter.export_heart_rate(args.date)
-        exporter.export_sleep_data(args.date)
-        exporter.export_weight_data(args.date)
+        exports = [
+            exporter.export_user_profile,
+            partial(exporter.export_daily_activity, args.date),
+            partial(exporter.export_heart_rate, args.date),
+            partial(exporter.export_sleep_data, args.date),
+            partial(exporter.export_weight_data, args.date),
+        ]
         
         # Export time series data
-        for resource in args.time_series:
-            exporter.export_time_series(resource, args.days)
+        exports += [partial(exporter.export_time_series, resource, args.days) for resource in args.time_series]
+        
+        # Each export is an independent Fitbit round-trip, so run them concurrently;
+        # the pool size matches the session's connection pool
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            wait([pool.submit(export) for export in exports])
         
-        # Output Prometheus metrics
-        print(exporter.get_metrics())
+        sys.stdout.buffer.flush()
         
     except Exception as e:
         print(f"# Error: {e}")
@@ -5,15 +5,28 @@ Pushes Fitbit metrics to Prometheus Push Gateway or Remote Write endpoint
 """
 
 import os
+import io
 import sys
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 from datetime import datetime
-from urllib.parse import urljoin
+from urllib.parse import urljoin, quote
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from itertools import groupby
 import base64
 import gzip
-import json
+import re
+import struct
+
+try:
+    import snappy
+    _snappy_compress = snappy.compress
+except ImportError:
+    _snappy_compress = None
 
 # Import our Fitbit API classes
 from fitbit_prometheus import FitbitAPI, PrometheusMetricsExporter
@@ -25,6 +38,110 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Days of time series history pushed in a full sync
+TIME_SERIES_DAYS = 7
+
+# Push Gateway bodies at least this large are sent gzip-compressed
+GZIP_MIN_BODY_SIZE = 4096
+
+# Headers identifying a snappy-compressed protobuf remote write body
+_REMOTE_WRITE_HEADERS = {
+    'Content-Type': 'application/x-protobuf',
+    'Content-Encoding': 'snappy',
+    'X-Prometheus-Remote-Write-Version': '0.1.0'
+}
+
+
+# Remote write payloads are prometheus.WriteRequest protobuf messages. The schema is
+# small and fixed, so the wire format is written directly rather than through generated code:
+#   WriteRequest { repeated TimeSeries timeseries = 1; }
+#   TimeSeries   { repeated Label labels = 1; repeated Sample samples = 2; }
+#   Label        { string name = 1; string value = 2; }
+#   Sample       { double value = 1; int64 timestamp = 2; }
+_DOUBLE = struct.Struct('<d')
+
+# Sample lines of the text exposition format: name{labels} value [timestamp].
+# Label values are quoted and may contain escaped quotes, so '}' inside them is allowed.
+_SAMPLE_RE = re.compile(
+    r'([a-zA-Z_:][\w:]*)'
+    r'(?:\{((?:[^"}]|"(?:[^"\\]|\\.)*")*)\})?'
+    r'\s+(\S+)(?:\s+(-?\d+))?\s*$'
+)
+_LABEL_RE = re.compile(r'([a-zA-Z_]\w*)\s*=\s*"((?:[^"\\]|\\.)*)"')
+_LABEL_UNESCAPE_RE = re.compile(r'\\(.)')
+
+# PrometheusMetricsExporter always writes 'name{k="v",...} value timestamp' with single spaces;
+# label values without escapes can be taken verbatim
+_EXPORTER_SAMPLE_RE = re.compile(r'([a-zA-Z_:][\w:]*)(?:\{((?:\w+="[^"\\]*",?)*)\})? (\S+) (\d+)\n?$')
+_PLAIN_LABEL_RE = re.compile(r'(\w+)="([^"]*)"')
+
+
+def _unescape_label_value(value):
+    """Undo exposition-format escaping of backslash, double-quote and line feed"""
+    return _LABEL_UNESCAPE_RE.sub(lambda m: '\n' if m.group(1) == 'n' else m.group(1), value)
+
+
+def _varint(value):
+    """Encode a non-negative integer as a protobuf varint"""
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _length_delimited(tag, payload):
+    """Encode a length-delimited protobuf field"""
+    return tag + _varint(len(payload)) + payload
+
+
+def _encode_label(name, value):
+    """Encode a prometheus.Label message"""
+    return (_length_delimited(b'\x0a', name.encode('utf-8')) +
+            _length_delimited(b'\x12', value.encode('utf-8')))
+
+
+def _encode_sample(value, timestamp):
+    """Encode a prometheus.Sample message"""
+    return b'\x09' + _DOUBLE.pack(value) + b'\x10' + _varint(timestamp)
+
+
+def _grouping_segment(name, value):
+    """Render a Push Gateway grouping key path segment"""
+    # The gateway decodes the path before routing, so a percent-encoded '/' would still
+    # split the path; such values (and empty ones) use the gateway's base64 form instead
+    if not value or '/' in value:
+        return f'{name}@base64/{base64.urlsafe_b64encode(value.encode("utf-8")).decode() or "="}'
+    return f'{name}/{quote(value, safe="")}'
+
+
+def _series_key(sample):
+    """Identify the series a parsed sample belongs to"""
+    return sample['metric_name'], sample['label_items']
+
+
+def _snappy_literal(data):
+    """Frame data as a valid, uncompressed snappy block made of literal elements only"""
+    out = bytearray(_varint(len(data)))
+    for start in range(0, len(data), 65536):
+        chunk = data[start:start + 65536]
+        n = len(chunk) - 1
+        if n < 60:
+            out.append(n << 2)
+        elif n < 256:
+            out += bytes((60 << 2, n))
+        else:
+            out.append(61 << 2)
+            out += n.to_bytes(2, 'little')
+        out += chunk
+    return bytes(out)
+
+
+if _snappy_compress is None:
+    # Endpoints accept any valid snappy block; install python-snappy for real compression
+    _snappy_compress = _snappy_literal
+
 class PrometheusPusher:
     """Push metrics to Prometheus Push Gateway or Remote Write endpoint"""
     
@@ -45,44 +162,80 @@ class PrometheusPusher:
         
         if not (self.push_gateway_url or self.remote_write_url or self.aws_workspace_id):
             raise ValueError("Must specify PROMETHEUS_PUSH_GATEWAY_URL, PROMETHEUS_REMOTE_WRITE_URL, or AWS_PROMETHEUS_WORKSPACE_ID")
-    
-    def _get_auth_headers(self):
-        """Get authentication headers"""
-        headers = {'Content-Type': 'text/plain; charset=utf-8'}
         
+        # Target labels attached to every remote write series
+        self._extra_label_items = (('instance', self.instance), ('job', self.job_name))
+        
+        # The grouping key never changes, so the Push Gateway target is built once
+        self._pg_target_url = urljoin(
+            self.push_gateway_url,
+            f'/metrics/{_grouping_segment("job", self.job_name)}/{_grouping_segment("instance", self.instance)}'
+        ) if self.push_gateway_url else None
+        
+        # Credentials don't change while running, so the auth header is built once
+        self._auth_headers = {'Content-Type': 'text/plain; charset=utf-8'}
         if self.bearer_token:
-            headers['Authorization'] = f'Bearer {self.bearer_token}'
+            self._auth_headers['Authorization'] = f'Bearer {self.bearer_token}'
         elif self.username and self.password:
             credentials = base64.b64encode(f'{self.username}:{self.password}'.encode()).decode()
-            headers['Authorization'] = f'Basic {credentials}'
+            self._auth_headers['Authorization'] = f'Basic {credentials}'
+        self._aws_credentials = None  # boto3 credentials, resolved on the first AWS push
         
-        return headers
+        # Keep connections to the push endpoints alive between push cycles;
+        # transient gateway errors are retried, the last response is still checked below
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=4,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=(429, 502, 503, 504),
+                allowed_methods=('POST',),
+                # Retry-After is not honoured, so a server-requested wait can't stall the push loop
+                respect_retry_after_header=False,
+                raise_on_status=False
+            )
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+    
+    def close(self):
+        """Close pooled connections to the push endpoints"""
+        self.session.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def _get_auth_headers(self):
+        """Get authentication headers (a copy callers may modify)"""
+        return dict(self._auth_headers)
     
-    def _get_aws_auth_headers(self):
-        """Get AWS SigV4 authentication headers for Prometheus"""
+    def _get_aws_auth_headers(self, body):
+        """Get AWS SigV4 authentication headers for Prometheus, signed over this request body"""
         try:
             import boto3
             from botocore.auth import SigV4Auth
             from botocore.awsrequest import AWSRequest
             
-            session = boto3.Session()
-            credentials = session.get_credentials()
-            
-            headers = {
-                'Content-Type': 'application/x-protobuf',
-                'Content-Encoding': 'snappy',
-                'X-Prometheus-Remote-Write-Version': '0.1.0'
-            }
+            # Credentials resolve (and refresh themselves) once; the payload hash is part of
+            # the signature, so every push has to be signed afresh
+            if self._aws_credentials is None:
+                self._aws_credentials = boto3.Session().get_credentials()
             
             # Create AWS request for signing
             request = AWSRequest(
                 method='POST',
                 url=self.remote_write_url,
-                headers=headers
+                data=body,
+                headers=dict(_REMOTE_WRITE_HEADERS)
             )
             
             # Sign the request
-            SigV4Auth(credentials, 'aps', self.aws_region).add_auth(request)
+            SigV4Auth(self._aws_credentials, 'aps', self.aws_region).add_auth(request)
             
             return dict(request.headers)
         except ImportError:
@@ -98,11 +251,17 @@ class PrometheusPusher:
             return False
         
         try:
-            url = urljoin(self.push_gateway_url, f'/metrics/job/{self.job_name}/instance/{self.instance}')
+            url = self._pg_target_url
             headers = self._get_auth_headers()
             
+            # Exposition text is very repetitive; even the fastest gzip level shrinks it several times
+            body = metrics_text.encode('utf-8')
+            if len(body) >= GZIP_MIN_BODY_SIZE:
+                body = gzip.compress(body, compresslevel=1)
+                headers['Content-Encoding'] = 'gzip'
+            
             logger.info(f"Pushing metrics to Push Gateway: {url}")
-            response = requests.post(url, data=metrics_text, headers=headers, timeout=30)
+            response = self.session.post(url, data=body, headers=headers, timeout=30)
             
             if response.status_code == 200:
                 logger.info("Successfully pushed metrics to Push Gateway")
@@ -120,9 +279,15 @@ class PrometheusPusher:
         if not self.remote_write_url:
             return False
         
+        # Convert Prometheus text format to remote write format
+        return self.push_samples_to_remote_write(self._parse_metrics_to_samples(io.StringIO(metrics_text)))
+    
+    def push_samples_to_remote_write(self, samples):
+        """Push already-parsed samples to Prometheus Remote Write endpoint"""
+        if not self.remote_write_url:
+            return False
+        
         try:
-            # Convert Prometheus text format to remote write format
-            samples = self._parse_metrics_to_samples(metrics_text)
             if not samples:
                 logger.warning("No valid samples to push")
                 return False
@@ -132,14 +297,13 @@ class PrometheusPusher:
             
             # Get appropriate headers
             if self.aws_workspace_id:
-                headers = self._get_aws_auth_headers()
+                headers = self._get_aws_auth_headers(write_request)
             else:
                 headers = self._get_auth_headers()
-                headers['Content-Type'] = 'application/x-protobuf'
-                headers['Content-Encoding'] = 'snappy'
+                headers.update(_REMOTE_WRITE_HEADERS)
             
             logger.info(f"Pushing metrics to Remote Write endpoint: {self.remote_write_url}")
-            response = requests.post(
+            response = self.session.post(
                 self.remote_write_url, 
                 data=write_request, 
                 headers=headers, 
@@ -157,110 +321,104 @@ class PrometheusPusher:
             logger.error(f"Error pushing to Remote Write: {e}")
             return False
     
-    def _parse_metrics_to_samples(self, metrics_text):
-        """Parse Prometheus text format to samples (simplified)"""
+    def _parse_metrics_to_samples(self, lines):
+        """Parse an iterable of Prometheus text format lines to samples"""
         samples = []
         timestamp = int(time.time() * 1000)  # Convert to milliseconds
+        debug = logger.isEnabledFor(logging.DEBUG)  # The level doesn't change mid-parse
         
-        for line in metrics_text.split('\n'):
-            line = line.strip()
-            if not line or line.startswith('#'):
+        for line in lines:
+            # Lines in our exporter's own shape take the fast path; anything else the general one.
+            # Comments, HELP/TYPE and blank lines match neither; a trailing newline is allowed
+            fast_match = _EXPORTER_SAMPLE_RE.match(line)
+            match = fast_match or _SAMPLE_RE.match(line)
+            if not match:
                 continue
             
+            metric_name, labels_part, value_part, timestamp_part = match.groups()
             try:
-                # Simple parser for metric_name{labels} value timestamp
-                if '{' in line:
-                    # Has labels
-                    metric_part, rest = line.split('{', 1)
-                    labels_part, value_part = rest.rsplit('}', 1)
-                    value_part = value_part.strip()
-                    
-                    # Parse labels
-                    labels = {}
-                    for label_pair in labels_part.split(','):
-                        if '=' in label_pair:
-                            key, val = label_pair.split('=', 1)
-                            labels[key.strip()] = val.strip().strip('"')
-                else:
-                    # No labels
-                    parts = line.split()
-                    if len(parts) >= 2:
-                        metric_part = parts[0]
-                        value_part = parts[1]
-                        labels = {}
-                
-                # Add instance and job labels
-                labels['job'] = self.job_name
-                labels['instance'] = self.instance
-                
-                # Parse value and timestamp
-                value_parts = value_part.split()
-                value = float(value_parts[0])
-                sample_timestamp = int(value_parts[1]) if len(value_parts) > 1 else timestamp
-                
-                samples.append({
-                    'metric_name': metric_part.strip(),
-                    'labels': labels,
-                    'value': value,
-                    'timestamp': sample_timestamp
-                })
-                
-            except Exception as e:
-                logger.debug(f"Failed to parse line '{line}': {e}")
+                value = float(value_part)
+            except ValueError:
+                if debug:
+                    logger.debug("Failed to parse line '%s': bad value", line.rstrip())
                 continue
-        
-        return samples
-    
-    def _create_remote_write_request(self, samples):
-        """Create remote write request (simplified JSON format for demonstration)"""
-        # Note: In production, you'd want to use proper Protocol Buffers
-        # This is a simplified approach that works with some endpoints
-        
-        time_series = {}
-        
-        # Group samples by metric and labels
-        for sample in samples:
-            # Create a key from metric name and labels
-            label_pairs = sorted(sample['labels'].items())
-            key = (sample['metric_name'], tuple(label_pairs))
             
-            if key not in time_series:
-                time_series[key] = {
-                    'labels': [{'name': k, 'value': v} for k, v in label_pairs],
-                    'samples': []
-                }
+            if not labels_part:
+                labels = {}
+            elif fast_match:
+                labels = dict(_PLAIN_LABEL_RE.findall(labels_part))
+            else:
+                labels = {}
+                for key, val in _LABEL_RE.findall(labels_part):
+                    labels[key] = _unescape_label_value(val) if '\\' in val else val
             
-            time_series[key]['samples'].append({
-                'value': sample['value'],
-                'timestamp': sample['timestamp']
+            samples.append({
+                'metric_name': metric_name,
+                'labels': labels,
+                'label_items': tuple(sorted(labels.items())),  # Canonical series key
+                'value': value,
+                'timestamp': int(timestamp_part) if timestamp_part else timestamp
             })
         
-        # Convert to remote write format
-        write_request = {
-            'timeseries': [
-                {
-                    'labels': ts_data['labels'],
-                    'samples': ts_data['samples']
-                }
-                for ts_data in time_series.values()
+        return samples
+    
+    def samples_from_exporter(self, exporter):
+        """Build samples straight from an exporter created with collect_samples=True"""
+        timestamp = exporter.timestamp
+        samples = []
+        for metric_name, label_items, value in exporter.get_samples():
+            labels = {k: str(v) for k, v in label_items}
+            samples.append({
+                'metric_name': metric_name,
+                'labels': labels,
+                'label_items': tuple(sorted(labels.items())),  # Canonical series key
+                'value': float(value),
+                'timestamp': timestamp
+            })
+        return samples
+    
+    def _create_remote_write_request(self, samples):
+        """Create a snappy-compressed protobuf remote write request"""
+        # Each series' samples arrive together (normally one sample per series), so runs of
+        # equal keys are merged as they stream past instead of grouping through a dict.
+        # A series that reappears later is sent as another TimeSeries entry, which is valid.
+        write_request = []
+        for (metric_name, label_items), series_samples in groupby(samples, key=_series_key):
+            encoded_samples = [
+                _length_delimited(b'\x12', _encode_sample(sample['value'], sample['timestamp']))
+                for sample in series_samples
             ]
-        }
+            # Remote write carries the metric name as the __name__ label, plus the
+            # job/instance target labels (which win over scraped ones); labels must be sorted
+            labels = dict(label_items)
+            labels.update(self._extra_label_items)
+            labels['__name__'] = metric_name
+            encoded_labels = b''.join([_length_delimited(b'\x0a', _encode_label(k, v)) for k, v in sorted(labels.items())])
+            write_request.append(_length_delimited(b'\x0a', encoded_labels + b''.join(encoded_samples)))
         
-        # For this example, we'll send as JSON (some endpoints support this)
-        # In production, use proper protobuf + snappy compression
-        return json.dumps(write_request).encode('utf-8')
+        return _snappy_compress(b''.join(write_request))
     
-    def push_metrics(self, metrics_text):
-        """Push metrics to configured endpoint(s)"""
-        success = False
+    def push_metrics(self, metrics_text, samples=None):
+        """Push metrics to configured endpoint(s); remote write uses samples instead of parsing when given"""
+        pushes = []
         
         if self.push_gateway_url:
-            success |= self.push_to_gateway(metrics_text)
+            pushes.append(partial(self.push_to_gateway, metrics_text))
         
         if self.remote_write_url or self.aws_workspace_id:
-            success |= self.push_to_remote_write(metrics_text)
+            if samples is not None:
+                pushes.append(partial(self.push_samples_to_remote_write, samples))
+            else:
+                pushes.append(partial(self.push_to_remote_write, metrics_text))
         
-        return success
+        if len(pushes) > 1:
+            # The endpoints are independent, so push to them at the same time over the shared session
+            with ThreadPoolExecutor(max_workers=len(pushes), thread_name_prefix='prometheus-push') as pool:
+                results = list(pool.map(lambda push: push(), pushes))
+        else:
+            results = [push() for push in pushes]
+        
+        return any(results)
 
 class FitbitMetricsPusher:
     """Main class to collect and push Fitbit metrics"""
@@ -269,6 +427,20 @@ class FitbitMetricsPusher:
         self.fitbit = FitbitAPI()
         self.pusher = PrometheusPusher()
         
+        # Remote write keeps every past sample, so after one full time series window per day
+        # only today needs re-sending. A Push Gateway replaces whole metric families on every
+        # push, so it is always sent the full window.
+        self._delta_time_series = not self.pusher.push_gateway_url
+        self._last_full_sync = None  # Date of the last successful full time series push
+        
+        # One exporter is reused across push cycles and reset before each collection.
+        # Remote write is fed the exporter's samples directly rather than re-parsing its text
+        self._remote_write = bool(self.pusher.remote_write_url or self.pusher.aws_workspace_id)
+        self.exporter = PrometheusMetricsExporter(self.fitbit, collect_samples=self._remote_write)
+        
+        # Exports are independent Fitbit round-trips; the pool size matches FitbitAPI's connection pool
+        self._pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='fitbit-export')
+        
         if not self.fitbit.access_token:
             raise ValueError("No access token available. Set FITBIT_ACCESS_TOKEN environment variable.")
     
@@ -277,37 +449,59 @@ class FitbitMetricsPusher:
         try:
             logger.info("Collecting metrics from Fitbit API...")
             
-            # Create exporter and gather metrics
-            exporter = PrometheusMetricsExporter(self.fitbit)
+            # Start from an empty exporter and gather metrics
+            exporter = self.exporter
+            exporter.reset()
             
-            # Export all available data
-            exporter.export_user_profile()
-            exporter.export_daily_activity(date)
-            exporter.export_heart_rate(date)
-            exporter.export_sleep_data(date)
-            exporter.export_weight_data(date)
+            # Export all available data concurrently
+            exports = [
+                exporter.export_user_profile,
+                partial(exporter.export_daily_activity, date),
+                partial(exporter.export_heart_rate, date),
+                partial(exporter.export_sleep_data, date),
+                partial(exporter.export_weight_data, date),
+            ]
+            futures = [self._pool.submit(export) for export in exports]
             
             # Export time series for common metrics
-            for resource in ['steps', 'distance', 'calories']:
-                try:
-                    exporter.export_time_series(resource, days=7)
-                except Exception as e:
-                    logger.warning(f"Failed to export {resource} time series: {e}")
+            today = datetime.now().date()
+            full_sync = not self._delta_time_series or self._last_full_sync != today
+            days = TIME_SERIES_DAYS if full_sync else 1
+            time_series = {
+                self._pool.submit(exporter.export_time_series, resource, days=days): resource
+                for resource in ['steps', 'distance', 'calories']
+            }
+            
+            wait(futures + list(time_series))
+            time_series_ok = True
+            for future, resource in time_series.items():
+                if future.exception() is not None:
+                    logger.warning(f"Failed to export {resource} time series: {future.exception()}")
+                    time_series_ok = False
+                elif not future.result():
+                    # export_time_series reports fetch errors as a metric rather than raising
+                    logger.warning(f"Failed to fetch {resource} time series")
+                    time_series_ok = False
             
             # Get metrics text
-            metrics_text = exporter.get_metrics()
+            metrics_text = exporter.get_metrics().decode('utf-8')
             
             if not metrics_text.strip():
                 logger.warning("No metrics collected")
                 return False
             
-            logger.info(f"Collected {len(metrics_text.split('\\n'))} metric lines")
+            line_count = metrics_text.count('\n')
+            logger.info(f"Collected {line_count} metric lines")
             
             # Push to Prometheus
-            success = self.pusher.push_metrics(metrics_text)
+            samples = self.pusher.samples_from_exporter(exporter) if self._remote_write else None
+            success = self.pusher.push_metrics(metrics_text, samples)
             
             if success:
                 logger.info("Successfully pushed metrics to Prometheus")
+                # A resource that failed during the full sync must get its window re-sent next cycle
+                if full_sync and time_series_ok:
+                    self._last_full_sync = today
             else:
                 logger.error("Failed to push metrics to Prometheus")
             
@@ -321,17 +515,28 @@ class FitbitMetricsPusher:
         """Run continuous metric collection and pushing"""
         logger.info(f"Starting continuous metric pushing every {interval} seconds")
         
+        # Schedule pushes on a fixed monotonic grid so the period doesn't drift by each cycle's work time
+        next_deadline = time.monotonic()
         while True:
+            next_deadline += interval
             try:
                 self.collect_and_push_metrics()
-                logger.info(f"Next push in {interval} seconds")
-                time.sleep(interval)
+                
+                sleep_for = next_deadline - time.monotonic()
+                if sleep_for < 0:
+                    # Don't fire the missed ticks back-to-back; restart the grid from now
+                    logger.warning(f"Push cycle overran the interval by {-sleep_for:.1f}s")
+                    next_deadline = time.monotonic() + interval
+                    sleep_for = interval
+                logger.info(f"Next push in {sleep_for:.0f} seconds")
+                time.sleep(sleep_for)
             except KeyboardInterrupt:
                 logger.info("Stopping continuous execution")
                 break
             except Exception as e:
                 logger.error(f"Error in continuous run: {e}")
                 time.sleep(min(interval, 60))  # Wait at least 1 minute on error
+                next_deadline = time.monotonic()
 
 def main():
     """Main function"""